@@ -1,9 +1,22 @@
 import sqlite3
-import hashlib
+import os
 import datetime
+import time
 import enum
-import getpass
-import textwrap 
+import queue
+import contextlib
+import collections
+
+DB_PATH = 'shuttle.db'
+TRANSACTIONS_PAGE_SIZE = 50
+DB_PRAGMAS = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+PRAGMA temp_store=MEMORY;
+PRAGMA foreign_keys=ON;
+"""
 
 class UserRole(enum.Enum):
     RIDER = "Rider"
@@ -15,17 +28,28 @@ class TripStatus(enum.Enum):
     COMPLETED = "Completed"
     AUTO_COMPLETED = "AutoCompleted"
 
+# Partial indexes are only used when a query repeats their WHERE clause
+# literally, so active-trip filters inline this instead of binding it.
+ACTIVE_STATUS_SQL = f"'{TripStatus.ACTIVE.value}'"
+
 class TransactionType(enum.Enum):
     RIDE_PAYMENT = "RidePayment"
     ADD_FUNDS = "AddFunds"
     ADMIN_ADJUSTMENT = "AdminAdjustment" 
 
+# A stop on the route a driver is running, loaded once per session.
+RouteStop = collections.namedtuple(
+    "RouteStop", "id stop_order distance_from_start name route_name"
+)
+
 def setup_database():
     """
     Creates the database file and all necessary tables.
     """
-    conn = sqlite3.connect('shuttle.db')
+    global _pool
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
+    cursor.executescript(DB_PRAGMAS)
     cursor.execute("""
     CREATE TABLE IF NOT EXISTS user (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -54,7 +78,8 @@ def setup_database():
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT UNIQUE NOT NULL,
         base_fare REAL NOT NULL DEFAULT 0.50,
-        price_per_km REAL NOT NULL DEFAULT 0.25
+        price_per_km REAL NOT NULL DEFAULT 0.25,
+        max_distance REAL NOT NULL DEFAULT 0.0
     );
     """)
     cursor.execute("""
@@ -74,7 +99,7 @@ def setup_database():
         rider_id INTEGER NOT NULL,
         shuttle_id INTEGER NOT NULL,
         tap_on_route_stop_id INTEGER NOT NULL,
-        tap_on_time TEXT NOT NULL,
+        tap_on_time INTEGER NOT NULL,
         status TEXT NOT NULL DEFAULT 'Active',
         FOREIGN KEY (rider_id) REFERENCES user (id),
         FOREIGN KEY (shuttle_id) REFERENCES shuttle (id),
@@ -87,69 +112,238 @@ def setup_database():
         rider_id INTEGER NOT NULL,
         amount REAL NOT NULL,
         type TEXT NOT NULL,
-        timestamp TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
         related_trip_id INTEGER,
         FOREIGN KEY (rider_id) REFERENCES user (id),
         FOREIGN KEY (related_trip_id) REFERENCES active_trip (id)
     );
     """)
+    route_columns = [column[1] for column in cursor.execute("PRAGMA table_info(route)")]
+    if 'max_distance' not in route_columns:
+        cursor.execute("ALTER TABLE route ADD COLUMN max_distance REAL NOT NULL DEFAULT 0.0")
+        refresh_route_max_distance(cursor)
+    # Databases created before timestamps were stored as epoch milliseconds
+    # still hold ISO-8601 local times; convert those rows in place, once.
+    if cursor.execute("PRAGMA user_version").fetchone()[0] < 1:
+        for table, column in (("transaction_log", "timestamp"), ("active_trip", "tap_on_time")):
+            cursor.execute(f"""
+            UPDATE {table}
+            SET {column} = CAST(ROUND((julianday({column}, 'utc') - 2440587.5) * 86400000) AS INTEGER)
+            WHERE typeof({column}) = 'text' AND {column} LIKE '____-__-__T%'
+            """)
+        cursor.execute("PRAGMA user_version = 1")
+    # Only the few trips still in progress are ever looked up, so index just those.
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_active_only_rider ON active_trip (rider_id) WHERE status = {ACTIVE_STATUS_SQL}")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_active_only_shuttle ON active_trip (shuttle_id) WHERE status = {ACTIVE_STATUS_SQL}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_route_stop_route_order ON route_stop (route_id, stop_order)")
+    # The id tiebreak is indexed too, so ORDER BY timestamp DESC, id DESC needs no temp sort.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_txn_rider_type_ts_id ON transaction_log (rider_id, type, timestamp DESC, id DESC)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_txn_ts_id ON transaction_log (timestamp DESC, id DESC)")
     conn.commit()
     conn.close()
+    if _pool is None:
+        _pool = ConnectionPool(DB_PATH)
+
+class ConnectionPool:
+    """
+    A small pool of pre-opened database connections.
+    Each connection is configured once when it is created and then
+    reused, instead of opening a new file handle for every call.
+    """
+    def __init__(self, db_path, size=4):
+        self.db_path = db_path
+        self._connections = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._connections.put(self._create_connection())
+
+    def _create_connection(self):
+        # Pooled connections live for the whole run, so keep enough prepared
+        # statements cached that repeated tap and lookup queries are not re-parsed.
+        # Write transactions take the write lock up front (BEGIN IMMEDIATE).
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=256,
+            isolation_level="IMMEDIATE"
+        )
+        conn.row_factory = sqlite3.Row
+        conn.executescript(DB_PRAGMAS)
+        conn.create_function("round_fare", 1, round_fare, deterministic=True)
+        return conn
+
+    def get(self):
+        """Takes a connection from the pool, waiting if none are free."""
+        return self._connections.get()
 
-def get_db_connection():
-    """Helper function to create a database connection."""
-    conn = sqlite3.connect('shuttle.db')
-    conn.row_factory = sqlite3.Row 
-    return conn
+    def put(self, conn):
+        """Returns a connection to the pool, discarding any uncommitted work."""
+        if conn.in_transaction:
+            conn.rollback()
+        self._connections.put(conn)
+
+    def close_all(self):
+        """Closes every connection currently held by the pool."""
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+_pool = None
+
+@contextlib.contextmanager
+def get_connection():
+    """Borrows a connection from the pool for the duration of a with-block."""
+    if _pool is None:
+        raise RuntimeError("Database not initialised. Call setup_database() first.")
+    conn = _pool.get()
+    try:
+        yield conn
+    finally:
+        _pool.put(conn)
+
+# Route data rarely changes during a shift, so it is cached per process
+# and only dropped when an admin edits routes.
+_route_cache = {}
+_route_stop_cache = {}
+
+def invalidate_route_cache():
+    """Clears cached route and route stop data after an edit."""
+    _route_cache.clear()
+    _route_stop_cache.clear()
+
+def refresh_route_max_distance(cursor, route_id=None):
+    """
+    Recomputes route.max_distance, the furthest stop distance on a route,
+    for one route or for every route when no route_id is given.
+    """
+    sql = """
+    UPDATE route SET max_distance = (
+        SELECT COALESCE(MAX(distance_from_start), 0.0) FROM route_stop WHERE route_id = route.id
+    )
+    """
+    if route_id is None:
+        cursor.execute(sql)
+    else:
+        cursor.execute(sql + " WHERE id = ?", (route_id,))
+
+def get_route(conn, route_id):
+    """Returns a route's fare data, including 'max_distance', as a dict, loading it on first use."""
+    route = _route_cache.get(route_id)
+    if route is None:
+        row = conn.execute(
+            "SELECT id, name, base_fare, price_per_km, max_distance FROM route WHERE id = ?", (route_id,)
+        ).fetchone()
+        if not row:
+            return None
+        route = dict(row)
+        _route_cache[route_id] = route
+    return route
+
+def get_route_stop(conn, route_stop_id):
+    """Returns a route stop as a dict, loading it on first use."""
+    route_stop = _route_stop_cache.get(route_stop_id)
+    if route_stop is None:
+        row = conn.execute(
+            "SELECT id, route_id, stop_id, stop_order, distance_from_start FROM route_stop WHERE id = ?",
+            (route_stop_id,)
+        ).fetchone()
+        if not row:
+            return None
+        route_stop = dict(row)
+        _route_stop_cache[route_stop_id] = route_stop
+    return route_stop
+
+def now_ms():
+    """Returns the current time as integer epoch milliseconds, as stored in the database."""
+    return time.time_ns() // 1_000_000
+
+def format_timestamp(timestamp_ms):
+    """Formats a stored epoch-millisecond timestamp as local 'YYYY-MM-DD HH:MM'."""
+    return datetime.datetime.fromtimestamp(int(timestamp_ms) / 1000).strftime('%Y-%m-%d %H:%M')
+
+def round_fare(amount):
+    """Rounds a fare to cents. Also registered as an SQL function on pooled connections."""
+    return round(amount, 2)
+
+# SQL form of calculate_fare() for the maximum fare of a trip, given the
+# tap-on stop as "rs" and its route as "r". Uses round_fare() rather than
+# SQLite's ROUND(), which rounds halves differently from Python.
+MAX_FARE_SQL = "round_fare(r.base_fare + (r.max_distance - rs.distance_from_start) * r.price_per_km)"
+
+def calculate_fare(route, distance):
+    """Returns the fare for travelling the given distance on a route."""
+    return round_fare(route['base_fare'] + (distance * route['price_per_km']))
+
+# hashlib, hmac and getpass are imported where they are used, since
+# they are only needed for logins and registrations, not at startup.
+def _scrypt(password, salt):
+    import hashlib
+    return hashlib.scrypt(password.encode(), salt=salt, n=16384, r=8, p=1, dklen=32)
 
 def hash_password(password):
-    """Hashes a password for storing securely."""
-    return hashlib.sha256(password.encode()).hexdigest()
+    """Hashes a password for storing securely, as 'scrypt$<salt>$<hash>'."""
+    salt = os.urandom(16)
+    return f"scrypt${salt.hex()}${_scrypt(password, salt).hex()}"
 
 def check_password(stored_hash, provided_password):
-    """Checks if the provided password matches the stored hash."""
-    return stored_hash == hashlib.sha256(provided_password.encode()).hexdigest()
+    """
+    Checks if the provided password matches the stored hash.
+    Accepts both scrypt hashes and legacy unsalted SHA-256 hex digests.
+    """
+    import hashlib
+    import hmac
+    if stored_hash.startswith("scrypt$"):
+        try:
+            _, salt_hex, hash_hex = stored_hash.split("$")
+            salt = bytes.fromhex(salt_hex)
+        except ValueError:
+            # A malformed stored hash can never match.
+            return False
+        provided_hash = _scrypt(provided_password, salt).hex()
+        return hmac.compare_digest(hash_hex, provided_hash)
+    provided_hash = hashlib.sha256(provided_password.encode()).hexdigest()
+    return hmac.compare_digest(stored_hash, provided_hash)
+
+def needs_rehash(stored_hash):
+    """Returns True if the stored hash uses the legacy SHA-256 format."""
+    return not stored_hash.startswith("scrypt$")
 
 def seed_data():
     """Populates the database with initial test data."""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM user WHERE username = 'admin'")
-    if cursor.fetchone():
-        conn.close()
-        return
-    print("Seeding database...")
-    admin_pass = hash_password("admin123")
-    driver_pass = hash_password("driver123")
-    rider_pass = hash_password("rider123")
-    cursor.execute("""
-    INSERT INTO user (username, email, password_hash, role, wallet_balance)
-    VALUES 
-        ('admin', 'admin@campus.edu', ?, ?, 0.0),
-        ('driver1', 'driver1@campus.edu', ?, ?, 0.0),
-        ('rider1', 'rider1@campus.edu', ?, ?, 10.0)
-    """, (admin_pass, UserRole.ADMIN.value, 
-          driver_pass, UserRole.DRIVER.value, 
-          rider_pass, UserRole.RIDER.value))
-    cursor.execute("INSERT INTO stop (name) VALUES ('Library'), ('Engineering Bldg'), ('Dorm Quad'), ('Student Union')")
-    cursor.execute("INSERT INTO route (name, base_fare, price_per_km) VALUES ('Campus Loop', 0.50, 0.25)")
-    route_id = cursor.lastrowid 
-    stops = cursor.execute("SELECT id, name FROM stop").fetchall()
-    stop_map = {name: id for id, name in stops} 
-    route_stops = [
-        (route_id, stop_map['Library'], 1, 0.0),
-        (route_id, stop_map['Engineering Bldg'], 2, 0.8),
-        (route_id, stop_map['Dorm Quad'], 3, 1.5),
-        (route_id, stop_map['Student Union'], 4, 2.1)
-    ]
-    cursor.executemany("INSERT INTO route_stop (route_id, stop_id, stop_order, distance_from_start) VALUES (?, ?, ?, ?)", route_stops)
-    cursor.execute("INSERT INTO shuttle (name, capacity) VALUES ('Shuttle #1', 15)")
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM user WHERE username = 'admin'")
+        if cursor.fetchone():
+            return
+        print("Seeding database...")
+        users = [
+            ('admin', 'admin@campus.edu', hash_password("admin123"), UserRole.ADMIN.value, 0.0),
+            ('driver1', 'driver1@campus.edu', hash_password("driver123"), UserRole.DRIVER.value, 0.0),
+            ('rider1', 'rider1@campus.edu', hash_password("rider123"), UserRole.RIDER.value, 10.0)
+        ]
+        stop_names = [("Library",), ("Engineering Bldg",), ("Dorm Quad",), ("Student Union",)]
+        with conn:
+            cursor.executemany(
+                "INSERT INTO user (username, email, password_hash, role, wallet_balance) VALUES (?, ?, ?, ?, ?)",
+                users
+            )
+            cursor.executemany("INSERT INTO stop (name) VALUES (?)", stop_names)
+            cursor.execute("INSERT INTO route (name, base_fare, price_per_km) VALUES ('Campus Loop', 0.50, 0.25)")
+            route_id = cursor.lastrowid 
+            stops = cursor.execute("SELECT id, name FROM stop").fetchall()
+            stop_map = {name: id for id, name in stops} 
+            route_stops = [
+                (route_id, stop_map['Library'], 1, 0.0),
+                (route_id, stop_map['Engineering Bldg'], 2, 0.8),
+                (route_id, stop_map['Dorm Quad'], 3, 1.5),
+                (route_id, stop_map['Student Union'], 4, 2.1)
+            ]
+            cursor.executemany("INSERT INTO route_stop (route_id, stop_id, stop_order, distance_from_start) VALUES (?, ?, ?, ?)", route_stops)
+            refresh_route_max_distance(cursor, route_id)
+            cursor.execute("INSERT INTO shuttle (name, capacity) VALUES ('Shuttle #1', 15)")
     print("Database seeding complete.")
 
 def register_user():
     """Handles the user registration flow."""
+    import getpass
     print("\n--- New User Registration ---")
     username = input("Username: ").strip()
     email = input("Email: ").strip()
@@ -160,30 +354,35 @@ def register_user():
         return
     role = UserRole.RIDER.value
     hashed_password = hash_password(password)
-    conn = get_db_connection()
     try:
-        conn.cursor().execute(
-            "INSERT INTO user (username, email, password_hash, role) VALUES (?, ?, ?, ?)",
-            (username, email, hashed_password, role)
-        )
-        conn.commit()
+        with get_connection() as conn:
+            with conn:
+                conn.cursor().execute(
+                    "INSERT INTO user (username, email, password_hash, role) VALUES (?, ?, ?, ?)",
+                    (username, email, hashed_password, role)
+                )
         print(f"Success! Rider account '{username}' created.")
     except sqlite3.IntegrityError as e:
         print(f"Error: Username or email already exists. {e}")
-    finally:
-        conn.close()
 
 def login_user():
     """Handles the user login flow."""
+    import getpass
     print("\n--- User Login ---")
     username = input("Username: ").strip()
     password = getpass.getpass("Password: ").strip()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM user WHERE username = ?", (username,))
-    user = cursor.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, username, role, password_hash FROM user WHERE username = ?", (username,))
+        user = cursor.fetchone()
     if user and check_password(user['password_hash'], password):
+        if needs_rehash(user['password_hash']):
+            with get_connection() as conn:
+                with conn:
+                    conn.execute(
+                        "UPDATE user SET password_hash = ? WHERE id = ?",
+                        (hash_password(password), user['id'])
+                    )
         print(f"\nWelcome, {user['username']}! (Role: {user['role']})")
         return user 
     else:
@@ -192,12 +391,11 @@ def login_user():
 
 def view_balance(user):
     """Fetches and displays the user's current wallet balance."""
-    conn = get_db_connection()
-    balance = conn.cursor().execute(
-        "SELECT wallet_balance FROM user WHERE id = ?", 
-        (user['id'],)
-    ).fetchone()
-    conn.close()
+    with get_connection() as conn:
+        balance = conn.cursor().execute(
+            "SELECT wallet_balance FROM user WHERE id = ?", 
+            (user['id'],)
+        ).fetchone()
     print(f"\nYour current wallet balance is: ${balance['wallet_balance']:.2f}")
 
 def add_funds(user):
@@ -208,86 +406,100 @@ def add_funds(user):
         if amount <= 0:
             print("Amount must be positive.")
             return
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE user SET wallet_balance = wallet_balance + ? WHERE id = ?", (amount, user['id']))
-        cursor.execute(
-            """
-            INSERT INTO transaction_log (rider_id, amount, type, timestamp) 
-            VALUES (?, ?, ?, ?)
-            """,
-            (user['id'], amount, TransactionType.ADD_FUNDS.value, datetime.datetime.now().isoformat())
-        )
-        conn.commit()
+        with get_connection() as conn:
+            with conn:
+                cursor = conn.cursor()
+                new_balance = cursor.execute(
+                    "UPDATE user SET wallet_balance = wallet_balance + ? WHERE id = ? RETURNING wallet_balance",
+                    (amount, user['id'])
+                ).fetchone()['wallet_balance']
+                cursor.execute(
+                    """
+                    INSERT INTO transaction_log (rider_id, amount, type, timestamp) 
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    (user['id'], amount, TransactionType.ADD_FUNDS.value, now_ms())
+                )
         print(f"${amount:.2f} successfully added.")
-        view_balance(user) 
+        print(f"\nYour current wallet balance is: ${new_balance:.2f}")
     except ValueError:
         print("Invalid amount. Please enter a number.")
     except Exception as e:
         print(f"An error occurred: {e}")
-        conn.rollback() 
-    finally:
-        if conn:
-            conn.close()
 
 def view_ride_history(user):
     """Displays a user's past ride transactions."""
     print("\n--- Your Ride History ---")
-    conn = get_db_connection()
-    history = conn.cursor().execute(
-        """
-        SELECT timestamp, amount, related_trip_id 
-        FROM transaction_log
-        WHERE rider_id = ? AND type = ?
-        ORDER BY timestamp DESC
-        """,
-        (user['id'], TransactionType.RIDE_PAYMENT.value)
-    ).fetchall()
-    conn.close()
+    with get_connection() as conn:
+        history = conn.cursor().execute(
+            """
+            SELECT timestamp, amount, related_trip_id 
+            FROM transaction_log
+            WHERE rider_id = ? AND type = ?
+            ORDER BY timestamp DESC, id DESC
+            """,
+            (user['id'], TransactionType.RIDE_PAYMENT.value)
+        ).fetchall()
     if not history:
         print("You have no ride history.")
         return
     print("Date & Time            | Amount  | Trip ID")
     print("-" * 40)
     for ride in history:
-        ts = datetime.datetime.fromisoformat(ride['timestamp']).strftime('%Y-%m-%d %H:%M')
+        ts = format_timestamp(ride['timestamp'])
         print(f"{ts:<20} | ${ride['amount'] * -1:<7.2f} | {ride['related_trip_id']}")
 
 def view_all_users():
     """Admin function to view all users."""
     print("\n--- All System Users ---")
-    conn = get_db_connection()
-    users = conn.cursor().execute(
-        "SELECT id, username, email, role, wallet_balance FROM user"
-    ).fetchall()
-    conn.close()
+    with get_connection() as conn:
+        users = conn.cursor().execute(
+            "SELECT id, username, email, role, wallet_balance FROM user"
+        ).fetchall()
     print("ID | Username   | Email            | Role    | Balance")
     print("-" * 55)
     for user in users:
         print(f"{user['id']:<2} | {user['username']:<10} | {user['email']:<16} | {user['role']:<7} | ${user['wallet_balance']:.2f}")
 
-def view_all_transactions():
-    """Admin function to view all transactions."""
+def view_all_transactions(page_size=TRANSACTIONS_PAGE_SIZE):
+    """Admin function to view all transactions, one page at a time."""
     print("\n--- All System Transactions ---")
-    conn = get_db_connection()
-    txns = conn.cursor().execute(
-        """
-        SELECT t.id, t.timestamp, u.username, t.type, t.amount
-        FROM transaction_log t
-        JOIN user u ON t.rider_id = u.id
-        ORDER BY t.timestamp DESC
-        """
-    ).fetchall()
-    conn.close()
-    if not txns:
-        print("No transactions found.")
-        return
-        
-    print("ID  | Date & Time            | Username   | Type          | Amount")
-    print("-" * 70)
-    for t in txns:
-        ts = datetime.datetime.fromisoformat(t['timestamp']).strftime('%Y-%m-%d %H:%M')
-        print(f"{t['id']:<3} | {ts:<20} | {t['username']:<10} | {t['type']:<13} | ${t['amount']:.2f}")
+    # Page by the (timestamp, id) of the last row shown rather than an OFFSET,
+    # so rows written by other processes between pages neither repeat nor
+    # shift the listing, and each page is a single index range read.
+    last_seen = None
+    while True:
+        # Borrow a connection for one page only, so it is back in the pool
+        # while waiting at the next-page prompt. One extra row is fetched to
+        # find out whether another page follows.
+        after_clause = "" if last_seen is None else "WHERE (t.timestamp, t.id) < (?, ?)"
+        with get_connection() as conn:
+            txns = conn.execute(
+                f"""
+                SELECT t.id, t.timestamp, u.username, t.type, t.amount
+                FROM transaction_log t
+                JOIN user u ON t.rider_id = u.id
+                {after_clause}
+                ORDER BY t.timestamp DESC, t.id DESC
+                LIMIT ?
+                """,
+                (*(last_seen or ()), page_size + 1)
+            ).fetchall()
+        if last_seen is None and not txns:
+            print("No transactions found.")
+            return
+        if last_seen is None:
+            print("ID  | Date & Time            | Username   | Type          | Amount")
+            print("-" * 70)
+        page = txns[:page_size]
+        for t in page:
+            ts = format_timestamp(t['timestamp'])
+            print(f"{t['id']:<3} | {ts:<20} | {t['username']:<10} | {t['type']:<13} | ${t['amount']:.2f}")
+        if len(txns) <= page_size:
+            return
+        last_seen = (page[-1]['timestamp'], page[-1]['id'])
+        if input("Press Enter for the next page, or 'q' to stop: ").strip().lower() == 'q':
+            return
 
 def create_stop():
     """Admin function to create a new stop."""
@@ -296,18 +508,15 @@ def create_stop():
     if not name:
         print("Name cannot be empty.")
         return
-    conn = get_db_connection()
     try:
-        conn.cursor().execute("INSERT INTO stop (name) VALUES (?)", (name,))
-        conn.commit()
+        with get_connection() as conn:
+            with conn:
+                conn.cursor().execute("INSERT INTO stop (name) VALUES (?)", (name,))
         print(f"Success: Stop '{name}' created.")
     except sqlite3.IntegrityError:
         print(f"Error: Stop name '{name}' already exists.")
     except Exception as e:
         print(f"An error occurred: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
 
 def create_shuttle():
     """Admin function to create a new shuttle."""
@@ -318,10 +527,9 @@ def create_shuttle():
         if not name:
             print("Name cannot be empty.")
             return
-        conn = get_db_connection()
-        conn.cursor().execute("INSERT INTO shuttle (name, capacity) VALUES (?, ?)", (name, capacity))
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            with conn:
+                conn.cursor().execute("INSERT INTO shuttle (name, capacity) VALUES (?, ?)", (name, capacity))
         print(f"Success: Shuttle '{name}' created with capacity {capacity}.")
     except ValueError:
         print("Error: Capacity must be an integer.")
@@ -338,13 +546,13 @@ def create_route():
         if not name:
             print("Name cannot be empty.")
             return
-        conn = get_db_connection()
-        conn.cursor().execute(
-            "INSERT INTO route (name, base_fare, price_per_km) VALUES (?, ?, ?)",
-            (name, base_fare, price_per_km)
-        )
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            with conn:
+                conn.cursor().execute(
+                    "INSERT INTO route (name, base_fare, price_per_km) VALUES (?, ?, ?)",
+                    (name, base_fare, price_per_km)
+                )
+        invalidate_route_cache()
         print(f"Success: Route '{name}' created.")
     except ValueError:
         print("Error: Fares must be numbers.")
@@ -356,33 +564,40 @@ def create_route():
 def add_stop_to_route():
     """Admin function to add an existing stop to an existing route."""
     print("\n--- Add Stop to Route ---")
-    conn = get_db_connection()
+    with get_connection() as conn:
+        routes = conn.execute("SELECT id, name FROM route").fetchall()
+        stops = conn.execute("SELECT id, name FROM stop").fetchall()
     try:
-        routes = conn.cursor().execute("SELECT id, name FROM route").fetchall()
         print("Available Routes:")
         for r in routes:
             print(f"  ID {r['id']}: {r['name']}")
         route_id = int(input("Enter Route ID to modify: "))
-        stops = conn.cursor().execute("SELECT id, name FROM stop").fetchall()
+        if route_id not in {r['id'] for r in routes}:
+            print(f"Error: Route ID {route_id} does not exist.")
+            return
         print("\nAvailable Stops:")
         for s in stops:
             print(f"  ID {s['id']}: {s['name']}")
         stop_id = int(input("Enter Stop ID to add: "))
+        if stop_id not in {s['id'] for s in stops}:
+            print(f"Error: Stop ID {stop_id} does not exist.")
+            return
         stop_order = int(input("Enter stop order (e.g., 1, 2, 3...): "))
         distance_from_start = float(input("Enter distance from start (in km): "))
-        conn.cursor().execute(
-            "INSERT INTO route_stop (route_id, stop_id, stop_order, distance_from_start) VALUES (?, ?, ?, ?)",
-            (route_id, stop_id, stop_order, distance_from_start)
-        )
-        conn.commit()
+        with get_connection() as conn:
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "INSERT INTO route_stop (route_id, stop_id, stop_order, distance_from_start) VALUES (?, ?, ?, ?)",
+                    (route_id, stop_id, stop_order, distance_from_start)
+                )
+                refresh_route_max_distance(cursor, route_id)
+        invalidate_route_cache()
         print("Success: Stop added to route.")
     except ValueError:
         print("Error: IDs and order must be integers, distance must be a number.")
     except Exception as e:
         print(f"An error occurred: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
 
 def adjust_user_balance():
     """Admin function to manually add or remove funds from a user."""
@@ -391,122 +606,112 @@ def adjust_user_balance():
         username = input("Enter username of the user to adjust: ").strip()
         amount = float(input("Enter amount to add (use negative for removal): $"))
         reason = input("Enter reason for adjustment (e.g., 'Refund'): ").strip()
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        user = cursor.execute("SELECT id FROM user WHERE username = ?", (username,)).fetchone()
-        if not user:
-            print(f"Error: User '{username}' not found.")
-            conn.close()
-            return
-        cursor.execute(
-            "UPDATE user SET wallet_balance = wallet_balance + ? WHERE id = ?",
-            (amount, user['id'])
-        )
-        cursor.execute(
-            """
-            INSERT INTO transaction_log (rider_id, amount, type, timestamp) 
-            VALUES (?, ?, ?, ?)
-            """,
-            (user['id'], amount, TransactionType.ADMIN_ADJUSTMENT.value, datetime.datetime.now().isoformat())
-        )
-        conn.commit()
-        print(f"Success: User '{username}'s balance adjusted by ${amount:.2f}.")
+        with get_connection() as conn:
+            with conn:
+                cursor = conn.cursor()
+                user = cursor.execute(
+                    "UPDATE user SET wallet_balance = wallet_balance + ? WHERE username = ? RETURNING id, wallet_balance",
+                    (amount, username)
+                ).fetchone()
+                if not user:
+                    print(f"Error: User '{username}' not found.")
+                    return
+                cursor.execute(
+                    """
+                    INSERT INTO transaction_log (rider_id, amount, type, timestamp) 
+                    VALUES (?, ?, ?, ?)
+                    """,
+                    (user['id'], amount, TransactionType.ADMIN_ADJUSTMENT.value, now_ms())
+                )
+        print(f"Success: User '{username}'s balance adjusted by ${amount:.2f}. New balance: ${user['wallet_balance']:.2f}")
     except ValueError:
         print("Error: Amount must be a number.")
     except Exception as e:
         print(f"An error occurred: {e}")
-        conn.rollback()
-    finally:
-        if conn:
-            conn.close()
 
 def process_rider_tap(rider_username, current_route_stop, shuttle_id):
     """
     The main "brain" of the system.
     Processes a single tap from a rider on the driver's device.
     """
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    try:
-        rider = cursor.execute("SELECT * FROM user WHERE username = ?", (rider_username,)).fetchone()
-        if not rider:
-            print(f"Error: Rider '{rider_username}' not found.")
-            return
-        current_stop_data = cursor.execute(
-            "SELECT * FROM route_stop WHERE id = ?", (current_route_stop['id'],)
-        ).fetchone()
-        route_data = cursor.execute(
-            "SELECT * FROM route WHERE id = ?", (current_stop_data['route_id'],)
-        ).fetchone()
-        active_trip = cursor.execute(
-            "SELECT * FROM active_trip WHERE rider_id = ? AND status = ?",
-            (rider['id'], TripStatus.ACTIVE.value)
-        ).fetchone()
-        if active_trip:
-            tap_on_stop_data = cursor.execute(
-                "SELECT * FROM route_stop WHERE id = ?", (active_trip['tap_on_route_stop_id'],)
-            ).fetchone()
-            if active_trip['tap_on_route_stop_id'] == current_stop_data['id']:
-                print(f"[{rider['username']}] ALREADY TAPPED ON at this stop. Tap ignored.")
-                return
-            if tap_on_stop_data['route_id'] == current_stop_data['route_id']:
-                print(f"[{rider['username']}] Tapping OFF...")
-                dist_on = tap_on_stop_data['distance_from_start']
-                dist_off = current_stop_data['distance_from_start']
-                distance_traveled = abs(dist_off - dist_on)
-                fare = route_data['base_fare'] + (distance_traveled * route_data['price_per_km'])
-                fare = round(fare, 2) 
-                new_balance = rider['wallet_balance'] - fare
-                cursor.execute("UPDATE user SET wallet_balance = ? WHERE id = ?", (new_balance, rider['id']))
-                cursor.execute(
-                    """
-                    INSERT INTO transaction_log (rider_id, amount, type, timestamp, related_trip_id)
-                    VALUES (?, ?, ?, ?, ?)
+    with get_connection() as conn:
+        try:
+            with conn:
+                # Taps are the hot path, so read plain tuples rather than sqlite3.Row.
+                cursor = conn.cursor()
+                cursor.row_factory = None
+                # Take the write lock before reading the balance and active trip,
+                # so a concurrent tap for the same rider cannot act on stale reads.
+                cursor.execute("BEGIN IMMEDIATE")
+                rider = cursor.execute(
+                    f"""
+                    SELECT u.id, u.username, u.wallet_balance, at.id AS trip_id, at.tap_on_route_stop_id
+                    FROM user u
+                    LEFT JOIN active_trip at ON at.rider_id = u.id AND at.status = {ACTIVE_STATUS_SQL}
+                    WHERE u.username = ?
                     """,
-                    (rider['id'], -fare, TransactionType.RIDE_PAYMENT.value, datetime.datetime.now().isoformat(), active_trip['id'])
-                )
-                cursor.execute("UPDATE active_trip SET status = ? WHERE id = ?", (TripStatus.COMPLETED.value, active_trip['id']))
-                print(f"  Fare: ${fare:.2f}. New Balance: ${new_balance:.2f}")
-            else:
-                print(f"[{rider['username']}] FORGOT TO TAP OFF on a previous trip.")
-                old_route_id = tap_on_stop_data['route_id']
-                last_stop_data = cursor.execute(
-                    "SELECT * FROM route_stop WHERE route_id = ? ORDER BY stop_order DESC LIMIT 1",
-                    (old_route_id,)
+                    (rider_username,)
                 ).fetchone()
-                old_route_data = cursor.execute("SELECT * FROM route WHERE id = ?", (old_route_id,)).fetchone()
-                max_dist = abs(last_stop_data['distance_from_start'] - tap_on_stop_data['distance_from_start'])
-                max_fare = old_route_data['base_fare'] + (max_dist * old_route_data['price_per_km'])
-                max_fare = round(max_fare, 2)
-                new_balance = rider['wallet_balance'] - max_fare
-                cursor.execute("UPDATE user SET wallet_balance = ? WHERE id = ?", (new_balance, rider['id']))
-                cursor.execute(
-                    "INSERT INTO transaction_log (rider_id, amount, type, timestamp, related_trip_id) VALUES (?, ?, ?, ?, ?)",
-                    (rider['id'], -max_fare, TransactionType.RIDE_PAYMENT.value, datetime.datetime.now().isoformat(), active_trip['id'])
-                )
-                cursor.execute("UPDATE active_trip SET status = ? WHERE id = ?", (TripStatus.AUTO_COMPLETED.value, active_trip['id']))
-                print(f"  Charged max fare: ${max_fare:.2f}. New Balance: ${new_balance:.2f}")
-                rider = cursor.execute("SELECT * FROM user WHERE id = ?", (rider['id'],)).fetchone()
-                active_trip = None 
-        if not active_trip:
-            print(f"[{rider['username']}] Tapping ON...")
-            if rider['wallet_balance'] < route_data['base_fare']:
-                print(f"  TAP-ON FAILED. Insufficient funds (Min: ${route_data['base_fare']:.2f}, Has: ${rider['wallet_balance']:.2f})")
-                return
-            cursor.execute(
-                """
-                INSERT INTO active_trip (rider_id, shuttle_id, tap_on_route_stop_id, tap_on_time, status)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                (rider['id'], shuttle_id, current_stop_data['id'], datetime.datetime.now().isoformat(), TripStatus.ACTIVE.value)
-            )
-            print("  TAP-ON Successful. Trip started.")
-        conn.commit()
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        conn.rollback() 
-    finally:
-        conn.close()
+                if not rider:
+                    print(f"Error: Rider '{rider_username}' not found.")
+                    return
+                rider_id, username, wallet_balance, trip_id, tap_on_route_stop_id = rider
+                current_stop_data = get_route_stop(conn, current_route_stop.id)
+                route_data = get_route(conn, current_stop_data['route_id'])
+                has_active_trip = trip_id is not None
+                if has_active_trip:
+                    tap_on_stop_data = get_route_stop(conn, tap_on_route_stop_id)
+                    if tap_on_route_stop_id == current_stop_data['id']:
+                        print(f"[{username}] ALREADY TAPPED ON at this stop. Tap ignored.")
+                        return
+                    if tap_on_stop_data['route_id'] == current_stop_data['route_id']:
+                        print(f"[{username}] Tapping OFF...")
+                        distance_traveled = abs(current_stop_data['distance_from_start'] - tap_on_stop_data['distance_from_start'])
+                        fare = calculate_fare(route_data, distance_traveled)
+                        new_balance = cursor.execute(
+                            "UPDATE user SET wallet_balance = wallet_balance - ? WHERE id = ? RETURNING wallet_balance",
+                            (fare, rider_id)
+                        ).fetchone()[0]
+                        cursor.execute(
+                            """
+                            INSERT INTO transaction_log (rider_id, amount, type, timestamp, related_trip_id)
+                            VALUES (?, ?, ?, ?, ?)
+                            """,
+                            (rider_id, -fare, TransactionType.RIDE_PAYMENT.value, now_ms(), trip_id)
+                        )
+                        cursor.execute("UPDATE active_trip SET status = ? WHERE id = ?", (TripStatus.COMPLETED.value, trip_id))
+                        print(f"  Fare: ${fare:.2f}. New Balance: ${new_balance:.2f}")
+                    else:
+                        print(f"[{username}] FORGOT TO TAP OFF on a previous trip.")
+                        old_route_data = get_route(conn, tap_on_stop_data['route_id'])
+                        max_dist = abs(old_route_data['max_distance'] - tap_on_stop_data['distance_from_start'])
+                        max_fare = calculate_fare(old_route_data, max_dist)
+                        wallet_balance = cursor.execute(
+                            "UPDATE user SET wallet_balance = wallet_balance - ? WHERE id = ? RETURNING wallet_balance",
+                            (max_fare, rider_id)
+                        ).fetchone()[0]
+                        cursor.execute(
+                            "INSERT INTO transaction_log (rider_id, amount, type, timestamp, related_trip_id) VALUES (?, ?, ?, ?, ?)",
+                            (rider_id, -max_fare, TransactionType.RIDE_PAYMENT.value, now_ms(), trip_id)
+                        )
+                        cursor.execute("UPDATE active_trip SET status = ? WHERE id = ?", (TripStatus.AUTO_COMPLETED.value, trip_id))
+                        print(f"  Charged max fare: ${max_fare:.2f}. New Balance: ${wallet_balance:.2f}")
+                        has_active_trip = False
+                if not has_active_trip:
+                    print(f"[{username}] Tapping ON...")
+                    if wallet_balance < route_data['base_fare']:
+                        print(f"  TAP-ON FAILED. Insufficient funds (Min: ${route_data['base_fare']:.2f}, Has: ${wallet_balance:.2f})")
+                        return
+                    cursor.execute(
+                        """
+                        INSERT INTO active_trip (rider_id, shuttle_id, tap_on_route_stop_id, tap_on_time, status)
+                        VALUES (?, ?, ?, ?, ?)
+                        """,
+                        (rider_id, shuttle_id, current_stop_data['id'], now_ms(), TripStatus.ACTIVE.value)
+                    )
+                    print("  TAP-ON Successful. Trip started.")
+        except Exception as e:
+            print(f"An error occurred: {e}")
 
 def handle_end_of_shift(shuttle_id):
     """
@@ -514,87 +719,107 @@ def handle_end_of_shift(shuttle_id):
     by charging the max fare for their respective routes.
     """
     print("\nEnding shift. Checking for active riders...")
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    active_trips = cursor.execute(
-        "SELECT * FROM active_trip WHERE shuttle_id = ? AND status = ?",
-        (shuttle_id, TripStatus.ACTIVE.value)
-    ).fetchall()
-    if not active_trips:
-        print("No active trips to resolve.")
-        conn.close()
-        return
-    print(f"Resolving {len(active_trips)} active trip(s) for end of shift...")
-    for trip in active_trips:
+    with get_connection() as conn:
+        cursor = conn.cursor()
         try:
-            rider = cursor.execute("SELECT * FROM user WHERE id = ?", (trip['rider_id'],)).fetchone()
-            tap_on_stop_data = cursor.execute(
-                "SELECT * FROM route_stop WHERE id = ?", (trip['tap_on_route_stop_id'],)
-            ).fetchone()
-            route_id = tap_on_stop_data['route_id']
-            route_data = cursor.execute("SELECT * FROM route WHERE id = ?", (route_id,)).fetchone()
-            last_stop_data = cursor.execute(
-                "SELECT * FROM route_stop WHERE route_id = ? ORDER BY stop_order DESC LIMIT 1",
-                (route_id,)
-            ).fetchone()
-            max_dist = abs(last_stop_data['distance_from_start'] - tap_on_stop_data['distance_from_start'])
-            max_fare = route_data['base_fare'] + (max_dist * route_data['price_per_km'])
-            max_fare = round(max_fare, 2)
-            new_balance = rider['wallet_balance'] - max_fare
-            cursor.execute("UPDATE user SET wallet_balance = ? WHERE id = ?", (new_balance, rider['id']))
-            cursor.execute(
-                "INSERT INTO transaction_log (rider_id, amount, type, timestamp, related_trip_id) VALUES (?, ?, ?, ?, ?)",
-                (rider['id'], -max_fare, TransactionType.RIDE_PAYMENT.value, datetime.datetime.now().isoformat(), trip['id'])
-            )
-            cursor.execute("UPDATE active_trip SET status = ? WHERE id = ?", (TripStatus.AUTO_COMPLETED.value, trip['id']))
-            print(f"  Auto-completed trip for {rider['username']}. Charged max fare: ${max_fare:.2f}.")
+            with conn:
+                # Lock first so the trips summarised here are exactly the ones charged below.
+                cursor.execute("BEGIN IMMEDIATE")
+                active_trips = cursor.execute(
+                    f"""
+                    SELECT u.username, {MAX_FARE_SQL} AS max_fare
+                    FROM active_trip at
+                    JOIN user u ON u.id = at.rider_id
+                    JOIN route_stop rs ON rs.id = at.tap_on_route_stop_id
+                    JOIN route r ON r.id = rs.route_id
+                    WHERE at.shuttle_id = ? AND at.status = {ACTIVE_STATUS_SQL}
+                    ORDER BY at.id
+                    """,
+                    (shuttle_id,)
+                ).fetchall()
+                if not active_trips:
+                    print("No active trips to resolve.")
+                    return
+                print(f"Resolving {len(active_trips)} active trip(s) for end of shift...")
+                cursor.execute(
+                    f"""
+                    UPDATE user SET wallet_balance = wallet_balance - (
+                        SELECT SUM({MAX_FARE_SQL})
+                        FROM active_trip at
+                        JOIN route_stop rs ON rs.id = at.tap_on_route_stop_id
+                        JOIN route r ON r.id = rs.route_id
+                        WHERE at.rider_id = user.id AND at.shuttle_id = ? AND at.status = {ACTIVE_STATUS_SQL}
+                    )
+                    WHERE id IN (SELECT rider_id FROM active_trip WHERE shuttle_id = ? AND status = {ACTIVE_STATUS_SQL})
+                    """,
+                    (shuttle_id, shuttle_id)
+                )
+                cursor.execute(
+                    f"""
+                    INSERT INTO transaction_log (rider_id, amount, type, timestamp, related_trip_id)
+                    SELECT at.rider_id, -{MAX_FARE_SQL}, ?, ?, at.id
+                    FROM active_trip at
+                    JOIN route_stop rs ON rs.id = at.tap_on_route_stop_id
+                    JOIN route r ON r.id = rs.route_id
+                    WHERE at.shuttle_id = ? AND at.status = {ACTIVE_STATUS_SQL}
+                    """,
+                    (TransactionType.RIDE_PAYMENT.value, now_ms(), shuttle_id)
+                )
+                cursor.execute(
+                    f"UPDATE active_trip SET status = ? WHERE shuttle_id = ? AND status = {ACTIVE_STATUS_SQL}",
+                    (TripStatus.AUTO_COMPLETED.value, shuttle_id)
+                )
         except Exception as e:
-            print(f"  Error resolving trip {trip['id']}: {e}")
-    conn.commit()
-    conn.close()
+            print(f"  Error resolving trips for end of shift: {e}")
+            return
+        for trip in active_trips:
+            print(f"  Auto-completed trip for {trip['username']}. Charged max fare: ${trip['max_fare']:.2f}.")
 
 def start_driver_session(driver_user):
     """The main interface for a driver's active shift."""
-    conn = get_db_connection()
     try:
-        shuttles = conn.execute("SELECT * FROM shuttle").fetchall()
+        with get_connection() as conn:
+            shuttles = conn.execute("SELECT id, name, capacity FROM shuttle").fetchall()
+            routes = conn.execute("SELECT id, name, base_fare, price_per_km FROM route").fetchall()
         print("\n--- Select Your Shuttle ---")
         for s in shuttles:
             print(f"{s['id']}: {s['name']} (Capacity: {s['capacity']})")
         shuttle_id = int(input("Enter shuttle ID: "))
-        shuttle = conn.execute("SELECT * FROM shuttle WHERE id = ?", (shuttle_id,)).fetchone()
+        shuttle = next((s for s in shuttles if s['id'] == shuttle_id), None)
         if not shuttle:
             print("Invalid shuttle ID.")
-            conn.close()
             return
-        routes = conn.execute("SELECT * FROM route").fetchall()
         print("\n--- Select Your Route ---")
         for r in routes:
             print(f"{r['id']}: {r['name']} (Base: ${r['base_fare']:.2f}, Per/km: ${r['price_per_km']:.2f})")
         route_id = int(input("Enter route ID: "))
-        all_stops = conn.execute(
-            """
-            SELECT rs.id, rs.stop_order, rs.distance_from_start, s.name, r.name AS route_name
-            FROM route_stop rs
-            JOIN stop s ON rs.stop_id = s.id
-            JOIN route r ON rs.route_id = r.id
-            WHERE rs.route_id = ?
-            ORDER BY rs.stop_order
-            """, (route_id,)
-        ).fetchall()
-        conn.close()
+        if not any(r['id'] == route_id for r in routes):
+            print("Invalid route ID.")
+            return
+        with get_connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT rs.id, rs.stop_order, rs.distance_from_start, s.name, r.name AS route_name
+                FROM route_stop rs
+                JOIN stop s ON rs.stop_id = s.id
+                JOIN route r ON rs.route_id = r.id
+                WHERE rs.route_id = ?
+                ORDER BY rs.stop_order
+                """, (route_id,)
+            )
+            all_stops = [RouteStop(*row) for row in rows]
         if not all_stops:
             print("Error: This route has no stops defined. Returning to menu.")
             return
         current_stop_index = 0
         total_stops = len(all_stops)
         print(f"\n--- SESSION STARTED ---")
-        print(f"Driver: {driver_user['username']}, Shuttle: {shuttle['name']}, Route: {all_stops[0]['route_name']}")
+        print(f"Driver: {driver_user['username']}, Shuttle: {shuttle['name']}, Route: {all_stops[0].route_name}")
         
         while True:
             current_stop = all_stops[current_stop_index]
             print("\n" + "="*40)
-            print(f"  Current Stop: ({current_stop['stop_order']}/{total_stops}) {current_stop['name']}")
+            print(f"  Current Stop: ({current_stop.stop_order}/{total_stops}) {current_stop.name}")
             print("="*40)
             print("Commands: [next] stop, [tap] rider, [end] session")
             cmd = input("Enter command: ").strip().lower()
@@ -613,12 +838,8 @@ def start_driver_session(driver_user):
                 print("Invalid command.")   
     except ValueError:
         print("Invalid ID. Returning to menu.")
-        if conn:
-            conn.close()
     except Exception as e:
         print(f"An error occurred in driver session: {e}")
-        if conn:
-            conn.close()
 
 def rider_menu(user):
     """Displays the menu for a logged-in Rider."""
@@ -724,4 +945,7 @@ def main_menu():
 if __name__ == "__main__":
     setup_database()
     seed_data()
-    main_menu() 
+    try:
+        main_menu()
+    finally:
+        _pool.close_all()